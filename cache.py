@@ -1,32 +1,76 @@
 import pickle, os, pathlib
 from functools import wraps
+from itertools import islice
 from platformdirs import user_cache_dir
 
-def cached(func):
-    func.cache = {}
-    name = pathlib.Path(user_cache_dir('smartsplit', 'bisqwit'))
+name     = pathlib.Path(user_cache_dir('smartsplit', 'bisqwit'))
+file     = name / 'smartsplit.cache'
+file_tmp = name / 'smartsplit.cache.new'
+
+# The cache file is a sequence of pickled dicts. Each run appends the
+# entries it added as one more dict, and once there are this many of
+# them, the whole cache is written again as a single dict.
+MAX_RECORDS = 16
+
+def read():
+    """
+    The merged contents of the cache file, the number of dicts in it and
+    the length of the part that could be read. An incomplete dict at the
+    end (e.g. from an interrupted run) is left out.
+    """
+    cache, records, end = {}, 0, 0
     try:
-        os.mkdir(name)
+        with open(file, 'rb') as db:
+            while True:
+                cache.update(pickle.load(db))
+                records += 1
+                end = db.tell()
     except:
         pass
-    file     = name / 'smartsplit.cache'
-    file_tmp = name / 'smartsplit.cache.new'
+    return cache, records, end
+
+def load():
+    return read()[0]
+
+def cached(func):
     try:
-        with open(file, 'rb') as db:
-            func.cache = pickle.load(db)
+        os.mkdir(name)
     except:
         pass
+    func.cache, records, end = read()
+    saved = len(func.cache)
+    # Equal keys are kept as one object, so that pickle writes a key once
+    # per dict no matter how many results refer to it.
+    keys = {key: key for key in func.cache}
+    def key(args):
+        return keys.setdefault(args, args)
     def save():
-        with open(file_tmp, 'wb') as db:
-            pickle.dump(func.cache, db)
-        os.replace(file_tmp, file)
+        nonlocal saved, records, end
+        if len(func.cache) == saved:
+            return
+        if records + 1 >= MAX_RECORDS:
+            with open(file_tmp, 'wb') as db:
+                pickle.dump(func.cache, db)
+                records, end = 1, db.tell()
+            os.replace(file_tmp, file)
+        else:
+            # Entries are only ever added, so the new ones are at the end
+            with open(file, 'ab') as db:
+                db.truncate(end)
+                pickle.dump(dict(islice(func.cache.items(), saved, None)), db)
+                records, end = records + 1, db.tell()
+        saved = len(func.cache)
     cached.save = save
 
     @wraps(func)
     def wrapper(*args):
+        args = key(args)
         if args in func.cache:
             return func.cache[args]
         else:
-            func.cache[args] = result = func(*args)
-            return result   
+            result = func(*args)
+            # A recursive call may have stored a result for these arguments
+            # already, and other results may refer to it, so keep that one.
+            return func.cache.setdefault(args, result)
+    wrapper.key = key
     return wrapper
@@ -0,0 +1,57 @@
+from collections import Counter
+
+# Canonical form of a network, so that the same network reached through
+# different branches of the search (and therefore labelled differently)
+# can be recognized. Nodes are coloured by kind and value, and the colours
+# are refined Weisfeiler-Lehman style with the colours of each node's
+# sources and consumers. While some nodes are still indistinguishable,
+# the first of them is given a colour of its own and the refinement is
+# repeated. The final colours order the nodes.
+# Two networks with equal canonical forms are always isomorphic. For the
+# symmetric networks produced here the reverse also holds in practice.
+
+def refine(sources, consumers, colors):
+    # Colours are hashes of integer tuples, which do not vary between runs.
+    classes = len(set(colors))
+    while True:
+        colors = [hash((colors[i],
+                        tuple(sorted([colors[q] for q in sources[i]])),
+                        tuple(sorted([colors[c] for c in consumers[i]]))))
+                  for i in range(len(colors))]
+        n = len(set(colors))
+        if n == classes:
+            return colors
+        classes = n
+
+def canonical_form(code):
+    """
+    Return a hashable tuple of (kind, value, sources) lines in which
+    the node numbers do not depend on the order of "code".
+    """
+    sources   = [sorted(line[2:]) for line in code]
+    consumers = [[] for line in code]
+    for i, line in enumerate(code):
+        for q in line[2:]:
+            consumers[q].append(i)
+    kinds  = [(line[1], round(line[0], 5)) for line in code]
+    ranks  = {k: r for r, k in enumerate(sorted(set(kinds)))}
+    colors = refine(sources, consumers, [ranks[k] for k in kinds])
+    if len(set(colors)) < len(code):
+        # Twins (same colour, same sources and same consumers, such as the
+        # outputs of one splitter) can be told apart in any order.
+        twins = Counter()
+        keys  = []
+        for i in range(len(code)):
+            key = (colors[i], tuple(sources[i]), tuple(consumers[i]))
+            keys.append((colors[i], twins[key]))
+            twins[key] += 1
+        colors = refine(sources, consumers, [hash(k) for k in keys])
+    while len(set(colors)) < len(code):
+        counts = Counter(colors)
+        tied = min(c for c in counts if counts[c] > 1)
+        i = colors.index(tied)
+        colors[i] = hash((tied, -1))
+        colors = refine(sources, consumers, colors)
+    order = sorted(range(len(code)), key=colors.__getitem__)
+    pos   = {k: n for n, k in enumerate(order)}
+    return tuple(kinds[k] + tuple(sorted([pos[q] for q in sources[k]])) for k in order)
@@ -0,0 +1,160 @@
+from math import ceil
+from verify import simulate, verify
+
+# Optional exact backend: encodes "a network of at most K split2, split3
+# and merge nodes delivers these outputs" as a mixed integer program and
+# solves it with CBC through PuLP (pip3 install pulp). K is increased from
+# a trivial lower bound until a network is found, so the first one found
+# is proven to have the minimum number of buildings. The heuristic
+# solution is the upper bound; if the solver runs out of time before
+# reaching it, the remaining gap is reported.
+
+def buildings(code):
+    """Number of splitters and mergers needed to build "code"."""
+    count = 0
+    for line in code:
+        if line[1][:5] == 'split':
+            count += 1
+        elif line[1] == 'merge':
+            # A merger has at most three inputs
+            count += max(1, ceil((len(line) - 3) / 2))
+    return count
+
+def solve_k(goals, K, time_limit):
+    """
+    Look for a network with at most K nodes. Returns (status, code), where
+    status is 'found', 'infeasible' or 'unknown'.
+    """
+    import pulp
+
+    T = sum(goals)
+    N = len(goals)
+    # Flows inside loops may exceed the total. In a working network, flow
+    # leaving a node reaches an output along a simple path, which passes
+    # at most K splitters, with probability at least 3**-K. So no item
+    # visits a node more than 3**K times on average, and no flow exceeds
+    # T * 3**K. This bound leaves out no network.
+    M = T * 3**K
+    nodes = range(K)
+    ports = [('in', 0)] + [(i, p) for i in nodes for p in range(3)]
+    sinks = [('node', i) for i in nodes] + [('out', j) for j in range(N)]
+
+    prob = pulp.LpProblem('smartsplit', pulp.LpMinimize)
+    B = lambda name: pulp.LpVariable(name, cat='Binary')
+    C = lambda name: pulp.LpVariable(name, lowBound=0)
+    s2 = [B('s2_%d' % i) for i in nodes]
+    s3 = [B('s3_%d' % i) for i in nodes]
+    mg = [B('m_%d' % i) for i in nodes]
+    used = [s2[i] + s3[i] + mg[i] for i in nodes]
+    x  = [C('x_%d' % i) for i in nodes]
+    y, e, c, phi, active = {}, {}, {}, {}, {}
+    for port in ports:
+        i, p = port
+        phi[port] = C('phi_%s_%d' % port)
+        if i == 'in':
+            active[port] = 1
+        else:
+            active[port] = [used[i], s2[i] + s3[i], s3[i]][p]
+        for sink in sinks:
+            if sink == ('node', i):
+                continue # no self-loops
+            name = '%s_%d_%s_%d' % (port + sink)
+            y[port, sink] = B('y_' + name)
+            e[port, sink] = C('e_' + name)
+            c[port, sink] = C('c_' + name)
+
+    prob += pulp.lpSum(used)
+    for i in nodes:
+        prob += used[i] <= 1
+        if i + 1 < K:
+            prob += used[i] >= used[i+1] # symmetry breaking
+        prob += x[i] <= M * used[i]
+    for port in ports:
+        i, p = port
+        prob += pulp.lpSum(y[port, sink] for sink in sinks if (port, sink) in y) == active[port]
+        if i == 'in':
+            prob += phi[port] == T
+            continue
+        prob += phi[port] <= M * active[port]
+        # Port flow is x, x/2 or x/3 depending on the node kind
+        for kind, share in ((mg[i], 1), (s2[i], 2), (s3[i], 3)):
+            if share == 1 and p > 0:
+                continue
+            if share == 2 and p > 1:
+                continue
+            prob += phi[port] - x[i] * (1 / share) <= M * (1 - kind)
+            prob += x[i] * (1 / share) - phi[port] <= M * (1 - kind)
+    for (port, sink), var in y.items():
+        prob += e[port, sink] <= M * var
+        prob += e[port, sink] <= phi[port]
+        prob += e[port, sink] >= phi[port] - M * (1 - var)
+        prob += c[port, sink] <= (K + N) * var
+    incoming = lambda sink, v: pulp.lpSum(v[port, sink] for port in ports if (port, sink) in v)
+    for i in nodes:
+        sink = ('node', i)
+        n_in = incoming(sink, y)
+        prob += n_in >= s2[i] + s3[i] + 2 * mg[i]
+        prob += n_in <= s2[i] + s3[i] + 3 * mg[i]
+        prob += incoming(sink, e) == x[i]
+        # Every node must be reachable from the input: it consumes one
+        # unit of a separate commodity that only flows along used edges.
+        outgoing = pulp.lpSum(c[(i, p), s] for p in range(3) for s in sinks if ((i, p), s) in c)
+        prob += incoming(sink, c) - outgoing == used[i]
+    for j in range(N):
+        sink = ('out', j)
+        prob += incoming(sink, y) == 1
+        prob += incoming(sink, e) == goals[j]
+        prob += incoming(sink, c) == 1
+
+    status = prob.solve(pulp.PULP_CBC_CMD(msg=False, timeLimit=time_limit))
+    if status == pulp.LpStatusInfeasible:
+        return 'infeasible', None
+    if status != pulp.LpStatusOptimal:
+        return 'unknown', None
+
+    # Build the node list: input, the used nodes, then the outputs
+    kept  = [i for i in nodes if pulp.value(used[i]) > 0.5]
+    index = {('in', 0): 0}
+    code  = [[T, 'input']]
+    for i in kept:
+        index[i] = len(code)
+        kind = 'merge' if pulp.value(mg[i]) > 0.5 else 'split2' if pulp.value(s2[i]) > 0.5 else 'split3'
+        code.append([0, kind])
+    for j in range(N):
+        code.append([goals[j], 'output'])
+    for (port, sink), var in y.items():
+        if pulp.value(var) > 0.5:
+            src = index[('in', 0)] if port[0] == 'in' else index[port[0]]
+            dst = index[sink[1]] if sink[0] == 'node' else 1 + len(kept) + sink[1]
+            code[dst].append(src)
+    for line in code:
+        line[2:] = sorted(line[2:])
+    # Take the node values from an exact simulation rather than from the solver
+    flow = simulate(code)
+    for i, line in enumerate(code):
+        if line[1] != 'output':
+            line[0] = round(float(flow[i]), 5)
+    return 'found', code
+
+def exact_smartsplit(goals, upper=None, time_limit=60):
+    """
+    Find a network with the minimum number of buildings for "goals".
+    "upper" is a known solution (e.g. from the heuristic search).
+    Returns (code, lower, best): the best network known, the proven lower
+    bound for its building count, and its building count.
+    """
+    goals = sorted(q for q in goals if q)
+    best  = buildings(upper) if upper else None
+    K = max(0, ceil((len(goals) - 1) / 2))
+    if len(goals) == 1:
+        return [[goals[0], 'input'], [goals[0], 'output', 0]], 0, 0
+    while best is None or K < best:
+        status, code = solve_k(goals, K, time_limit)
+        if status == 'found' and not verify(goals, code):
+            return code, K, K
+        if status != 'infeasible':
+            # Out of time, or the solver's network does not really work
+            # (e.g. because of rounding). Either way K is not ruled out.
+            break
+        K += 1
+    return upper, K, best
@@ -0,0 +1,76 @@
+from partition import to_scaled_ints
+from math import gcd
+
+# Optimal sub-networks for small recurring ratios, in the node-list format
+# that labels_to_lines produces: node 0 is the input, and every other node
+# is [value, kind, sources...]. Keyed by the goal ratio in lowest terms.
+# Each one has been proven minimal in buildings with exact.py.
+GADGETS = {
+    (1, 1): [[2, 'input'],
+             [2, 'split2', 0],
+             [1, 'output', 1], [1, 'output', 1]],
+    (1, 1, 1): [[3, 'input'],
+                [3, 'split3', 0],
+                [1, 'output', 1], [1, 'output', 1], [1, 'output', 1]],
+    (1, 2): [[3, 'input'],
+             [3, 'split3', 0],
+             [2, 'merge', 1, 1],
+             [1, 'output', 1], [2, 'output', 2]],
+    (1, 3): [[4, 'input'],
+             [4, 'split2', 0],
+             [2, 'split2', 1],
+             [3, 'merge', 1, 2],
+             [1, 'output', 2], [3, 'output', 3]],
+    (2, 3): [[5, 'input'],
+             [6, 'merge', 0, 3],
+             [6, 'split2', 1],
+             [3, 'split3', 2],
+             [2, 'merge', 3, 3],
+             [3, 'output', 2], [2, 'output', 4]],
+    # Loop-back gadget for 1/5
+    (1, 4): [[5, 'input'],
+             [6, 'merge', 0, 3],
+             [6, 'split2', 1],
+             [3, 'split3', 2],
+             [4, 'merge', 2, 3],
+             [1, 'output', 3], [4, 'output', 4]],
+    # Loop-back gadget for 1/7
+    (1, 6): [[7, 'input'],
+             [9, 'merge', 0, 4, 4],
+             [9, 'split3', 1],
+             [6, 'merge', 2, 2],
+             [3, 'split3', 2],
+             [1, 'output', 4], [6, 'output', 3]],
+    (1, 1, 1, 1, 1): [[5, 'input'],
+                      [6, 'merge', 0, 3],
+                      [6, 'split2', 1],
+                      [3, 'split3', 2],
+                      [3, 'split3', 2],
+                      [1, 'output', 3], [1, 'output', 3],
+                      [1, 'output', 4], [1, 'output', 4], [1, 'output', 4]],
+}
+
+SIZES = set(len(key) for key in GADGETS)
+
+def find_gadget(nums):
+    """
+    Return a copy of the gadget for goals "nums", scaled to their total,
+    or None if the ratio is not in the table.
+    """
+    if len(nums) not in SIZES:
+        return None
+    arr, scale = to_scaled_ints(nums)
+    g = gcd(*arr)
+    code = GADGETS.get(tuple(sorted(a // g for a in arr)))
+    if code is None:
+        return None
+    total = sum(nums)
+    unit  = total / code[0][0]
+    res = [[line[0] * unit] + line[1:] for line in code]
+    res[0][0] = total
+    # Use the exact goal values for the outputs, so that callers can find them.
+    outputs = sorted((i for i, line in enumerate(res) if line[1] == 'output'),
+                     key=lambda i: res[i][0])
+    for i, value in zip(outputs, sorted(nums)):
+        res[i][0] = value
+    return res
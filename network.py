@@ -0,0 +1,175 @@
+# Conversions between the two representations of a network:
+# node lists, where node 0 is the input and every other node is
+# [value, kind, sources...] with sources given as node numbers, and
+# label lists, where every line is [value, label, kind, source labels...].
+
+from collections import defaultdict
+
+def lines_to_labels(code, pfx, first):
+  # "first" is the label for the input, or a list of labels for several inputs
+  trans = ["%s_%d" % (pfx,n) for n in range(len(code))]
+  if first is not None:
+    firsts = [first] if isinstance(first, str) else first
+    inputs = [n for n, line in enumerate(code) if line[1] == 'input']
+    for n, label in zip(inputs, firsts):
+      trans[n] = label
+  res = []
+  for n, line in enumerate(code):
+    if line[1] == 'input':
+      continue
+    res.append( [line[0], trans[n], line[1]] + sorted([trans[c] for c in line[2:]]) )
+  return sorted(res)
+
+def labels_to_lines(code, first, total):
+  # For several inputs, "first" and "total" are lists
+  if isinstance(first, str):
+    first, total = [first], [total]
+  trans = {}
+  n = 0
+  for label in first:
+    trans[label] = n
+    n += 1
+  for line in code:
+    r = [1] + list(range(3, len(line)))
+    for l in r:
+      if line[l] not in trans:
+        trans[line[l]] = n
+        n += 1
+  res = [None] * n
+  for k, value in enumerate(total):
+    res[k] = [value, 'input']
+  for line in code:
+    res[trans[line[1]]] = line[0:1] + line[2:3] + sorted([trans[k] for k in line[3:]])
+  #print("TRANS",trans)
+  return res
+
+def cleanup(total, code):
+  # If a merge pulls the same 'split2' twice, replace both sources with the split's source
+  # If a merge pulls the same 'split3' thrice, replace the three sources with the split's source
+  # If a merge has only one source, replace all pulls from this merge with pulls from the merge's source and delete the merge line
+  # If a merge pulls from a merge, merge the merges and reroute sources
+  # For a network with several inputs, "total" is the list of their rates.
+  first = 's' if not isinstance(total, list) else ['s%d' % n for n in range(len(total))]
+  firsts = [first] if isinstance(first, str) else first
+  spl = lines_to_labels(code, 'p', first)
+  spl = {line[1]:line for line in spl}
+  #print("Before clean:", spl)
+
+  is_split = {k:[spl[k][3],0] for k in spl if spl[k][2][:5]=='split'}
+  # For each split, determing how their k by counting how many nodes refer to it
+  for k in spl:
+    for q in spl[k][3:]:
+      if q in is_split:
+        is_split[q][1] += 1
+  redo = True
+  while redo:
+    redo = False
+    is_merge = set(k for k in spl if spl[k][2] == 'merge')
+    for k in sorted(is_merge):
+      uses = defaultdict(int)
+      for s in spl[k][3:]:
+        uses[s] += 1
+      changes = True
+      redo    = False
+      while changes:
+        changes = False
+        for s in uses:
+          if s in is_merge and uses[s] > 0:
+            # Add the referenced merge's sources
+            for s2 in spl[s][3:]:
+              uses[s2] += uses[s]
+            # And stop referring to that merge
+            uses[s] = 0
+            changes = True
+            break
+          if s in is_split and uses[s] >= is_split[s][1]:
+            uses[is_split[s][0]] += uses[s] // is_split[s][1]
+            uses[s]            %= is_split[s][1]
+            changes = True
+            break
+        if changes:
+          redo = True
+      if sum(uses.values()) == 1:
+        redo = True
+        for s in uses:
+          pass
+        # Replace all uses of k with s
+        for q in spl:
+          for i in range(3, len(spl[q])):
+            if spl[q][i] == k:
+              spl[q][i] = s
+        del spl[k]
+      elif redo:
+        r = []
+        for s in uses:
+          r += [s] * uses[s]
+        spl[k] = spl[k][:3] + r
+  #print("After  clean:", spl)
+  # Finally do a DFS through the tree and delete inaccessible nodes
+  if True: # BFS
+    todo    = [k for k in spl if spl[k][2] == 'output']
+    visited = set()
+    for k in todo:
+      if k not in visited:
+        visited.add(k)
+        for q in spl[k][3:]:
+          if q not in visited and q not in firsts:
+            todo.append(q)
+  else: # DFS
+    visited = set()
+    def dfs(k):
+      if k not in firsts and k not in visited:
+        visited.add(k)
+        for q in spl[k][3:]:
+          dfs(q)
+    for k in spl:
+      if spl[k][2] == 'output':
+        dfs(k)
+  return labels_to_lines([spl[k] for k in sorted(visited)], first, total)
+
+# Cached solutions are stored as recipes rather than as node lists.
+# A recipe only holds the lines that a solution added itself ("glue"),
+# and refers to each sub-solution it was built from by its goal key,
+# together with the labels under which it was embedded and the labels
+# that were removed from it. Expanding a recipe rebuilds the node list.
+
+def make_recipe(combined, first, total, children, solve):
+  """
+  Recipe for the network made of the label lines "combined", in which
+  each of "children", a list of (key, pfx, first), was embedded with
+  lines_to_labels(solve(*key), pfx, first). The nodes of a child that
+  are not in "combined" are listed by their index in solve(*key).
+  """
+  glue = [tuple(line) for line in combined]
+  present = set(line[1] for line in combined)
+  refs = []
+  for key, pfx, cfirst in children:
+    labels = set(line[1] for line in lines_to_labels(solve(*key), pfx, cfirst))
+    glue = [line for line in glue if line[1] not in labels]
+    deleted = sorted(int(label[len(pfx)+1:]) for label in labels - present)
+    refs.append((key, pfx, cfirst, tuple(deleted)))
+  return (first, total, tuple(glue), tuple(refs))
+
+def build(combined, first, total):
+  return labels_to_lines(sorted(combined), first, total)
+
+def expand_recipe(recipe, solve):
+  """Node list of the network described by "recipe", before cleanup."""
+  first, total, glue, refs = recipe
+  combined = [list(line) for line in glue]
+  for key, pfx, cfirst, deleted in refs:
+    deleted = set("%s_%d" % (pfx, n) for n in deleted)
+    combined += [line for line in lines_to_labels(solve(*key), pfx, cfirst) if line[1] not in deleted]
+  return build(combined, first, total)
+
+def expand(table, key, memo):
+  """Node list of the solution stored as table[key]. Expansions are kept in "memo"."""
+  if key not in memo:
+    recipe = table[key]
+    if recipe is None or isinstance(recipe, list):
+      # Node lists (e.g. gadgets, or an old cache) are stored as they are
+      memo[key] = recipe
+    else:
+      solve = lambda *k: expand(table, k, memo)
+      memo[key] = cleanup(recipe[1], expand_recipe(recipe, solve))
+  return memo[key]
@@ -4,7 +4,7 @@
 #
 # With thanks to IceMoonMagic.
 
-import itertools, functools, math, fractions, bisect, sys
+import itertools, functools, math, fractions, bisect, sys, argparse
 from collections import defaultdict
 
 import graphviz
@@ -12,6 +12,12 @@ import graphviz
 from partition import find_2_or_3_way_partition
 from cut3 import find_three_way_cut, split_into_three_groups, split_into_two_groups
 from cache import cached
+from network import lines_to_labels, labels_to_lines, cleanup, make_recipe, build, expand, expand_recipe
+from gadgets import find_gadget
+from verify import verify
+from exact import exact_smartsplit
+from canonical import canonical_form
+from stageprof import NullProfiler, Profiler
 
 def bisect_range(code, output_value):
   k   = lambda line: line[0]
@@ -19,45 +25,15 @@ def bisect_range(code, output_value):
   right = bisect.bisect_right(code, output_value, key=k)
   return [p for p in range(left,right) if code[p][2]=='output']
 
-def lines_to_labels(code, pfx, first):
-  trans = ["%s_%d" % (pfx,n) for n in range(len(code))]
-  if first is not None:
-    for n, line in enumerate(code):
-      if line[1] == 'input':
-       trans[n] = first
-       break
-  res = []
-  for n, line in enumerate(code):
-    if line[1] == 'input':
-      continue
-    res.append( [line[0], trans[n], line[1]] + sorted([trans[c] for c in line[2:]]) )
-  return sorted(res)
-
-def labels_to_lines(code, first, total):
-  trans = {}
-  n = 0
-  if first is not None:
-    trans[first] = 0
-    n += 1
-  for line in code:
-    r = [1] + list(range(3, len(line)))
-    for l in r:
-      if line[l] not in trans:
-        trans[line[l]] = n
-        n += 1
-  res = [None] * n
-  res[0] = [total, 'input']
-  for line in code:
-    res[trans[line[1]]] = line[0:1] + line[2:3] + sorted([trans[k] for k in line[3:]])
-  #print("TRANS",trans)
-  return res
-
-def change_source(lines, old_first, new_first):
-  res = []
-  for line in lines:
-    if line[2] != 'input':
-      res.append( line[0:3] + [new_first if q==old_first else q for q in line[3:]] )
-  #return lines
+def distinct_sources(code, positions):
+  # Outputs of equal value fed from the same node are interchangeable,
+  # so picking any one of them gives the same network.
+  seen = set()
+  res  = []
+  for p in positions:
+    if code[p][3] not in seen:
+      seen.add(code[p][3])
+      res.append(p)
   return res
 
 def list_except(list, *indices):
@@ -69,102 +45,160 @@ def list_except(list, *indices):
   res += list[prev:]
   return res
 
+def distinct_permutations(items):
+  # Like itertools.permutations, but equal items are not told apart,
+  # so each different order is generated only once (in sorted order).
+  perm = sorted(items)
+  while True:
+    yield tuple(perm)
+    i = len(perm) - 2
+    while i >= 0 and perm[i] >= perm[i+1]:
+      i -= 1
+    if i < 0:
+      return
+    j = len(perm) - 1
+    while perm[j] <= perm[i]:
+      j -= 1
+    perm[i], perm[j] = perm[j], perm[i]
+    perm[i+1:] = reversed(perm[i+1:])
+
+# The stages below are remembered per goal multiset, because dag_smartsplit
+# runs a node again once its children have been solved.
+
+@functools.cache
+def partition(portions):
+  return find_2_or_3_way_partition(list(portions))
+
+@functools.cache
+def common_measure(portions):
+  # Change all portions to same denominator, and express each of them as
+  # a number of pieces of their greatest common divisor. Returns the
+  # pieces, and (orig,piece,times) for every portion made of several
+  # pieces, or None if that does not simplify anything.
+  frac = [list(fractions.Fraction(v).as_integer_ratio()) for v in portions]
+  lcd = math.lcm(*(f[1] for f in frac))
+  for f in frac:
+      b = lcd // f[1]
+      f[0] *= b
+      f[1] *= b
+  gcf = math.gcd(*(f[0] for f in frac))
+  if any(f[0] != gcf for f in frac) and not any(f[1] != 1 for f in frac):
+    test   = []
+    merges = []
+    for f in frac:
+      num = gcf if f[1] == 1 else (gcf / f[1])
+      test += [num] * (f[0] // gcf)
+      if f[0] != gcf:# and num != 1:
+        times = f[0]//gcf
+        if times > 10:
+          return None
+        merges.append((f[0]/f[1], num/f[1], times)) # orig,piece,times
+    if len(merges):
+      return sorted(test), merges
+  return None
+
+@functools.cache
+def two_groups(portions):
+  # The distinct ways to cut the goals into two groups of equal sum,
+  # as (cut goal, group1, group2, piece in group1, piece in group2).
+  res = []
+  done_tests = set()
+  for perm in distinct_permutations(portions):
+    perm = list(perm)
+    ret = split_into_two_groups(perm)
+    if ret is None: continue
+    i,alpha,common_sum = ret
+    group1 = sorted(perm[:i]   + [left_extra  := round(alpha*perm[i], 5)])
+    group2 = sorted(perm[i+1:] + [right_extra := round((1-alpha)*perm[i], 5)])
+    t = tuple(group1)
+    if t in done_tests: continue
+    done_tests.add(t)
+    res.append((perm[i], group1, group2, left_extra, right_extra))
+  return res
+
 checking = defaultdict(int)
-def smartsplit(total, portions):
+def smartsplit(total, portions, solve):
   global checking
   print("smartsplit(",total,",",portions,")")
+  # Each candidate is yielded as (label lines, input label, total, children),
+  # where children lists the (key, pfx, first) of every sub-solution that
+  # was embedded with lines_to_labels(solve(*key), pfx, first).
   if len(portions) == 0:
     if total == 0:
-      yield [[total, 'input'], [total, 'output', 0]]
+      yield [[total, 'o', 'output', 's']], 's', total, []
   elif len(portions) == 1:
     if total == portions[0]:
-      yield [[total, 'input'], [total, 'output', 0]]
+      yield [[total, 'o', 'output', 's']], 's', total, []
   else:
     # Is there a way to divide the list into 2 groups that have equal sum?
     # Is there a way to divide the list into 3 groups that have equal sum?
-    res = find_2_or_3_way_partition(portions)
+    profiler.stage('partition')
+    res = partition(tuple(portions))
     if res is not None:
       k,groups = res
       if k <= len(portions) or True:
         #print("FOUND ",k,"-GROUPING",groups)
         sol  = [[total,'ss','split%d'%k,'s']]
+        children = []
         for gno,g in enumerate(groups):
           l = "g" + str(gno)
-          lf = "%s_fst"% l
-          p = do_smartsplit(*sorted(g))
+          p = solve(*sorted(g))
           if p is None:
             sol = []
             break
-          # Change lines that source "lf" to sourcing "ss" instead
-          q = change_source(lines_to_labels(p,l,lf),lf,'ss')
+          # Lines that sourced the input now source "ss" instead
+          q = lines_to_labels(p,l,'ss')
+          children.append((goal_key(g), l, 'ss'))
           #print("PARAM:",p, "--", q)
           sol += q
         if len(sol):
           #print("MADE:",sol)
-          yield labels_to_lines(sorted(sol), 's', total)
+          yield sol, 's', total, children
       return
 
     # Change all portions to same denominator.
-    if True:
-      frac = [list(fractions.Fraction(v).as_integer_ratio()) for v in portions]
-      lcd = math.lcm(*(f[1] for f in frac))
-      for f in frac:
-          b = lcd // f[1]
-          f[0] *= b
-          f[1] *= b
-      gcf = math.gcd(*(f[0] for f in frac))
-      if any(f[0] != gcf for f in frac) and not any(f[1] != 1 for f in frac):
-        test   = []
-        merges = []
-        foil = False
-        for f in frac:
-          num = gcf if f[1] == 1 else (gcf / f[1])
-          test += [num] * (f[0] // gcf)
-          if f[0] != gcf:# and num != 1:
-            times = f[0]//gcf
-            if times > 10:
-              foil = True
-              break
-            merges.append((f[0]/f[1], num/f[1], times)) # orig,piece,times
-
-        if len(merges) and not foil:
-          res = do_smartsplit(*sorted(test))
-          if res:
-            spl = lines_to_labels(res, 'p', 's')
-            print("SOLUTION FOR ",test," FROM ",portions,": ",spl)
-            combsets = []
-            for orig,piece,times in merges:
-              # Find all instances of line with 'output' with "piece" value.
-              # Pick "times" of those, and delete those and add a 'merge' line with those labels as params.
-              found = [spl[pos][1] for pos in bisect_range(spl, piece)]
-              #combs = [list(q) for q in itertools.combinations(found, times)]
-              combs = []
-              for q in itertools.combinations(found, times):
-                combs.append(q)
-                break
-              #print("COMBS:",combs)
-              combsets.append(combs)
-            #print("MERGE ",merges," PROPOSALS:", combsets)
-            # Change the code into a dict
-            spl = {line[1]:line for line in spl}
-            # Perform the merges
-            for sels in itertools.product(*combsets):
-              #print("SELS:",sels)
-              # Make sure no two "sels" refers to same elements
-              if len(set(q for z in sels for q in z)) != sum(len(z) for z in sels):
-                continue
-              # Make a copy of the dict
-              wip = {k:spl[k] for k in spl}
-              for sno,(orig,piece,times) in enumerate(merges):
-                #print("sels[%d]=%s" % (sno,sels[sno]))
-                wip["merge%d"%sno] = [orig,"merge%d"%sno, 'merge'] + [wip[q][3] for q in sels[sno]]
-                wip["out%d"%sno]   = [orig,"out%d"%sno,   'output',"merge%d"%sno]
-                for in_label in sels[sno]:
-                  del wip[in_label]
-              # Change the dict back into a list
-              #print("MERGED PROPOSAL:",list(wip.values()))#,labels_to_lines(wip.values(), 's', total))
-              yield labels_to_lines(wip.values(), 's', total)
-    
+    profiler.stage('gcd')
+    measure = common_measure(tuple(portions))
+    if measure:
+      test, merges = measure
+      res = solve(*test)
+      if res:
+        spl = lines_to_labels(res, 'p', 's')
+        print("SOLUTION FOR ",test," FROM ",portions,": ",spl)
+        combsets = []
+        for orig,piece,times in merges:
+          # Find all instances of line with 'output' with "piece" value.
+          # Pick "times" of those, and delete those and add a 'merge' line with those labels as params.
+          found = [spl[pos][1] for pos in bisect_range(spl, piece)]
+          #combs = [list(q) for q in itertools.combinations(found, times)]
+          combs = []
+          for q in itertools.combinations(found, times):
+            combs.append(q)
+            break
+          #print("COMBS:",combs)
+          combsets.append(combs)
+        #print("MERGE ",merges," PROPOSALS:", combsets)
+        # Change the code into a dict
+        spl = {line[1]:line for line in spl}
+        # Perform the merges
+        for sels in itertools.product(*combsets):
+          #print("SELS:",sels)
+          # Make sure no two "sels" refers to same elements
+          if len(set(q for z in sels for q in z)) != sum(len(z) for z in sels):
+            continue
+          # Make a copy of the dict
+          wip = {k:spl[k] for k in spl}
+          for sno,(orig,piece,times) in enumerate(merges):
+            #print("sels[%d]=%s" % (sno,sels[sno]))
+            wip["merge%d"%sno] = [orig,"merge%d"%sno, 'merge'] + [wip[q][3] for q in sels[sno]]
+            wip["out%d"%sno]   = [orig,"out%d"%sno,   'output',"merge%d"%sno]
+            for in_label in sels[sno]:
+              del wip[in_label]
+          # Change the dict back into a list
+          #print("MERGED PROPOSAL:",list(wip.values()))#,labels_to_lines(wip.values(), 's', total))
+          yield list(wip.values()), 's', total, [(goal_key(test), 'p', 's')]
+
+    profiler.stage('miss')
     if (total%6 != 0) and total >= 2:
       for div in (3,2,6):
         if total%div != 0:
@@ -174,24 +208,22 @@ def smartsplit(total, portions):
           if checking[q]:
             continue
           checking[q] += 1
-          res = do_smartsplit(*p)
+          res = solve(*p)
           checking[q] -= 1
           if res:
             spl = lines_to_labels(res, 'p', 's')
             # Find the an instance of line with 'output' with "miss" value.
             # Delete that line, and add a 'merge' line with that label and the top label of what we received.
             #print("Find ",miss,":", bisect_range(spl,miss)," in ",spl)
-            for pos in bisect_range(spl, miss):
+            for pos in distinct_sources(spl, bisect_range(spl, miss)):
               cand = spl[:pos] + spl[pos+1:] + [[total+miss, 's', 'merge', 'k', spl[pos][3]]]
               #print("FROM",total+miss, spl)
               #print("CAND",total,      cand)
-              out = labels_to_lines(cand, 'k', total)
-              #print("OUT ", out)
-              yield out
+              yield cand, 'k', total, [(goal_key(p), 'p', 's')]
     
-    def twoway_split(left,right, sum, left_extra,right_extra):
-      leftpos  = bisect_range(left, left_extra)
-      rightpos = bisect_range(right, right_extra)
+    def twoway_split(left,right, sum, left_extra,right_extra, children):
+      leftpos  = distinct_sources(left,  bisect_range(left, left_extra))
+      rightpos = distinct_sources(right, bisect_range(right, right_extra))
       base   = [[total, 'ss','split2','s'],
                 [sum,   'eo','output','extra']]
       for li in leftpos:
@@ -200,32 +232,23 @@ def smartsplit(total, portions):
                       [[sum, 'extra', 'merge', left[li][3], right[ri][3]]] +
                       list_except(left, li) +
                       list_except(right, ri))
-          temp = labels_to_lines(combined, 's', total)
-          yield temp
+          yield combined, 's', total, children
 
     if (total % 2 == 0 or total >= 2) and len(portions) <= 8:
       #for i,value in enumerate(portions):
-      half = total//2
-      done_tests = set()
-      for perm in itertools.permutations(portions):
-        perm = list(perm)
-        ret = split_into_two_groups(perm)
-        if ret is None: continue
-        i,alpha,common_sum = ret
-        group1 = sorted(perm[:i]   + [left_extra  := round(alpha*perm[i], 5)])
-        group2 = sorted(perm[i+1:] + [right_extra := round((1-alpha)*perm[i], 5)])
-        t = tuple(group1)
-        if t in done_tests: continue
-        done_tests.add(t)
-        left = do_smartsplit(*group1)
+      profiler.stage('twoway')
+      for value,group1,group2,left_extra,right_extra in two_groups(tuple(portions)):
+        left = solve(*group1)
         if not left: continue
-        right = do_smartsplit(*group2)
+        right = solve(*group2)
         if not right: continue
         left  = lines_to_labels(left,  'p', 'ss')
         right = lines_to_labels(right, 'q', 'ss')
-        yield from twoway_split(left,right, perm[i], left_extra,right_extra)
+        children = [(goal_key(group1), 'p', 'ss'), (goal_key(group2), 'q', 'ss')]
+        yield from twoway_split(left,right, value, left_extra,right_extra, children)
     
     if (total % 3 == 0 or total >= 3) and len(portions) <= 8 and False:
+      profiler.stage('threeway')
       done_tests = set()
       for perm in itertools.permutations(portions):
         perm = list(perm)
@@ -238,11 +261,11 @@ def smartsplit(total, portions):
         t = (tuple(group1), tuple(group2))
         if t in done_tests: continue
         done_tests.add(t)
-        part1 = do_smartsplit(*group1)
+        part1 = solve(*group1)
         if not part1: continue
-        part2 = do_smartsplit(*group2)
+        part2 = solve(*group2)
         if not part2: continue
-        part3 = do_smartsplit(*group3)
+        part3 = solve(*group3)
         if not part3: continue
         left  = lines_to_labels(part1, 'p', 'ss')
         mid   = lines_to_labels(part2, 'q', 'ss')
@@ -251,11 +274,12 @@ def smartsplit(total, portions):
         midpos1  = bisect_range(mid,  mid_extra1)
         midpos2  = bisect_range(mid,  mid_extra2)
         rightpos = bisect_range(right, right_extra)
+        children = [(goal_key(group1), 'p', 'ss'), (goal_key(group2), 'q', 'ss'), (goal_key(group3), 'r', 'ss')]
         
         if not len(midpos1) or not len(leftpos):
-          yield from twoway_split(left+mid, right, perm[j], mid_extra2,right_extra)
+          yield from twoway_split(left+mid, right, perm[j], mid_extra2,right_extra, children)
         elif not len(rightpos) or not len(midpos2):
-          yield from twoway_split(left, mid+right, perm[i], left_extra,mid_extra1)
+          yield from twoway_split(left, mid+right, perm[i], left_extra,mid_extra1, children)
         else:
           base   = [[total,     'ss','split3','s'],
                     [perm[i],  'eo1','output','extra1'],
@@ -273,9 +297,7 @@ def smartsplit(total, portions):
                             list_except(mid, mi1, mi2) +
                             list_except(right, ri))
                 print("COMBINED", combined)
-                temp = labels_to_lines(combined, 's', total)
-                print("BECAME", temp)
-                yield temp
+                yield combined, 's', total, children
 
 def eval_cost(option):
   return len(option) #sum(q[1] not in ('input','output') for q in option)
@@ -287,112 +309,548 @@ def validate(choices, code):
     for i,opt in enumerate(code):
       print("  %3d: %s" % (i, opt))
     
-def cleanup(total, code):
-  # If a merge pulls the same 'split2' twice, replace both sources with the split's source
-  # If a merge pulls the same 'split3' thrice, replace the three sources with the split's source
-  # If a merge has only one source, replace all pulls from this merge with pulls from the merge's source and delete the merge line
-  # If a merge pulls from a merge, merge the merges and reroute sources
-  spl = lines_to_labels(code, 'p', 's')
-  spl = {line[1]:line for line in spl}
-  #print("Before clean:", spl)
-
-  is_split = {k:[spl[k][3],0] for k in spl if spl[k][2][:5]=='split'}
-  # For each split, determing how their k by counting how many nodes refer to it
-  for k in spl:
-    for q in spl[k][3:]:
-      if q in is_split:
-        is_split[q][1] += 1
-  redo = True
-  while redo:
-    redo = False
-    is_merge = set(k for k in spl if spl[k][2] == 'merge')
-    for k in is_merge:
-      uses = defaultdict(int)
-      for s in spl[k][3:]:
-        uses[s] += 1
-      changes = True
-      redo    = False
-      while changes:
-        changes = False
-        for s in uses:
-          if s in is_merge and uses[s] > 0:
-            # Add the referenced merge's sources
-            for s2 in spl[s][3:]:
-              uses[s2] += uses[s]
-            # And stop referring to that merge
-            uses[s] = 0
-            changes = True
-            break
-          if s in is_split and uses[s] >= is_split[s][1]:
-            uses[is_split[s][0]] += uses[s] // is_split[s][1]
-            uses[s]            %= is_split[s][1]
-            changes = True
-            break
-        if changes:
-          redo = True
-      if sum(uses.values()) == 1:
-        redo = True
-        for s in uses:
-          pass
-        # Replace all uses of k with s
-        for q in spl:
-          for i in range(3, len(spl[q])):
-            if spl[q][i] == k:
-              spl[q][i] = s
-        del spl[k]
-      elif redo:
-        r = []
-        for s in uses:
-          r += [s] * uses[s]
-        spl[k] = spl[k][:3] + r
-  #print("After  clean:", spl)
-  # Finally do a DFS through the tree and delete inaccessible nodes
-  if True: # BFS
-    todo    = [k for k in spl if spl[k][2] == 'output']
-    visited = set()
-    for k in todo:
-      if k not in visited:
-        visited.add(k)
-        for q in spl[k][3:]:
-          if q not in visited and q != 's':
-            todo.append(q)
-  else: # DFS
-    visited = set()
-    def dfs(k):
-      if k != 's' and k not in visited:
-        visited.add(k)
-        for q in spl[k][3:]:
-          dfs(q)
-    for k in spl:
-      if spl[k][2] == 'output':
-        dfs(k)
-  return labels_to_lines([spl[k] for k in visited], 's', total)
+def goal_key(nums):
+  # The same object as the key in the cache, which keeps the file small
+  return solve_key.key(tuple(sorted(q for q in nums if q)))
+
+debug = False
+profiler = NullProfiler()
 
+def pick_best(nums, solve, missing=None):
+  # Returns the recipe of the best network (see network.py).
+  # If "missing" is given, all candidates are generated first, and they
+  # are only evaluated if "missing" is still empty by then.
+  # Small recurring ratios are looked up from the gadget table.
+  res = find_gadget(nums)
+  if res is not None:
+    return res
+  cands = profiler.generator('search', nums, smartsplit(sum(nums), nums, solve))
+  if missing is not None:
+    cands = list(cands)
+    if missing:
+      return None
+  seen = set()
+  for cand in cands:
+    if cand is None:
+      continue
+    with profiler.frame('cleanup', nums):
+      option = build(*cand[:3])
+    if debug:
+      # Different branches often produce the same network with different
+      # labels. Verifying it again would be a waste. (Without verification,
+      # the canonical form costs more than the cleanup it would save.)
+      form = canonical_form(option)
+      if form in seen:
+        continue
+      seen.add(form)
+    with profiler.frame('validate', nums):
+      validate(nums, option)
+    with profiler.frame('cleanup', nums):
+      option = cleanup(sum(nums), option)
+    if debug:
+      with profiler.frame('validate', nums):
+        for problem in verify(nums, option, float):
+          print("VERIFY", nums, ":", problem)
+    cost = eval_cost(option)
+    if res is None or cost < res[0]:
+      res = [cost, option, cand]
+  if res is None:
+    return None
+  recipe = make_recipe(*res[2], solve)
+  if debug and cleanup(sum(nums), expand_recipe(recipe, solve)) != res[1]:
+    print("RECIPE", nums, ": does not expand to the solution")
+  return recipe
 
 #from joblib import Memory
 #memory = Memory("cachedir")
 #@memory.cache
 @cached
+def solve_key(*key):
+  return pick_best(list(key), do_smartsplit)
+
+# Node lists of the cached solutions that have been expanded so far
+expanded = {}
+
 def do_smartsplit(*nums):
+  key = goal_key(nums)
+  solve_key(*key)
+  with profiler.frame('expand', key):
+    return expand(solve_key.cache, key, expanded)
+
+def dag_smartsplit(*nums, limit=None):
+  # Solve bottom-up over the DAG of goal multisets the query depends on.
+  # Each multiset is a node whose result goes into the same table that
+  # do_smartsplit uses. A node is tried with its unsolved children taken
+  # as solved, so that every stage goes on to find all of its children
+  # in one pass. If there were any, the candidates are thrown away, the
+  # children are solved, and the node is tried again.
+  # Only the current path is kept on the stack, so memory is bounded by
+  # the number of distinct multisets, not by the number of search paths.
+  # With "limit", gives up (returning None) after trying that many nodes.
+  # The nodes solved by then stay in the table.
+  table = solve_key.cache
+  root  = goal_key(nums)
+  if root in table:
+    return expand(table, root, expanded)
+  stack = [[root, []]] # [multiset, children still waiting to be solved]
+  path  = {root}
+  tries = 0
+  while stack:
+    key, pending = stack[-1]
+    if pending:
+      child = pending.pop()
+      if child not in table and child not in path:
+        stack.append([child, []])
+        path.add(child)
+      continue
+    missing = []
+    seen    = set()
+    def solve(*sub):
+      k = goal_key(sub)
+      # A multiset on the current path is a cycle. Like the 'checking'
+      # guard of the recursive solver, treat it as unsolvable.
+      if k in path:
+        return None
+      if k not in table and k not in seen:
+        seen.add(k)
+        missing.append(k)
+      if missing:
+        # The candidates will be thrown away; only the children matter.
+        return [[sum(sub), 'input']]
+      return expand(table, k, expanded)
+    tries += 1
+    if limit is not None and tries > limit:
+      return None
+    res = pick_best(list(key), solve, missing)
+    if missing:
+      pending += missing
+    else:
+      table[key] = res
+      stack.pop()
+      path.discard(key)
+  return expand(table, root, expanded)
+
+def find_output(spl, value, used):
+  for pos, line in enumerate(spl):
+    if line[2] == 'output' and pos not in used and abs(line[0] - value) < 1e-6:
+      return pos
+  return None
+
+def stitch(top, subs, total):
+  # Replace outputs of "top" with the networks in "subs", a list of
+  # (value, code) pairs. Each network is fed from the source of
+  # a different output that has the same value.
+  spl  = lines_to_labels(top, 't', 's')
+  used = set()
+  sol  = []
+  for gno,(value,code) in enumerate(subs):
+    pos = find_output(spl, value, used)
+    if pos is None:
+      return None
+    used.add(pos)
+    sol += lines_to_labels(code, 'h%d' % gno, spl[pos][3])
+  sol += list_except(spl, *used)
+  return labels_to_lines(sol, 's', total)
+
+hier_group = 4
+hier_limit = 200
+
+def bounded_smartsplit(*nums):
+  # The search, given up after "hier_limit" sub-problems, or the network
+  # with a loop-back, which always exists, if that is cheaper.
+  res  = cleanup(sum(nums), looped_smartsplit(nums))
+  code = dag_smartsplit(*nums, limit=hier_limit)
+  if code is not None and eval_cost(code) <= eval_cost(res):
+    res = code
+  return res
+
+def hierarchical_smartsplit(*nums):
+  # Cluster the goals into groups of at most "hier_group" goals, solve
+  # each group separately, and then feed the groups from a splitter tree
+  # that is built (hierarchically, too) for the group totals.
+  # Every group and tree is solved with bounded_smartsplit, so the time
+  # is bounded by the number of groups, but the result is not necessarily
+  # optimal.
+  nums = sorted(q for q in nums if q)
+  if len(nums) <= hier_group:
+    return bounded_smartsplit(*nums)
+  # Sorting places equal goals in the same group, where they are cheap to solve.
+  subs = []
+  for i in range(0, len(nums), hier_group):
+    group = nums[i:i+hier_group]
+    subs.append((sum(group), bounded_smartsplit(*group)))
+  top = hierarchical_smartsplit(*(value for value,code in subs))
+  res = stitch(top, subs, sum(nums))
+  validate(nums, res)
+  res = cleanup(sum(nums), res)
+  # One loop-back for all the goals can beat one for every group
+  flat = cleanup(sum(nums), looped_smartsplit(nums))
+  return flat if eval_cost(flat) < eval_cost(res) else res
+
+def incremental_smartsplit(old, nums, solve=do_smartsplit):
+  # Re-solve "nums" starting from the solution for the earlier goals "old".
+  # Everything is kept, except the outputs that are no longer wanted and
+  # the nodes that only fed them. The belts that those nodes took from
+  # the kept part, including loop-backs, are merged into a spare belt.
+  # Only a new front is solved, which feeds the kept part and the new
+  # outputs from the input and the spare belt.
+  code = solve(*old)
+  if code is None:
+    return solve(*nums)
+  nums = sorted(q for q in nums if q)
+  wanted = defaultdict(int)
+  for q in nums:
+    wanted[round(q, 5)] += 1
+  kept = set()
+  for i, line in enumerate(code):
+    if line[1] == 'output' and wanted[round(line[0], 5)] > 0:
+      wanted[round(line[0], 5)] -= 1
+      kept.add(i)
+  consumers = defaultdict(list)
+  for i, line in enumerate(code):
+    for q in line[2:]:
+      consumers[q].append(i)
+  removed = set(i for i, line in enumerate(code) if line[1] == 'output' and i not in kept)
+  changes = True
+  while changes:
+    changes = False
+    for i, line in enumerate(code):
+      if i not in removed and line[1] != 'input' and consumers[i] and \
+         all(k in removed for k in consumers[i]):
+        removed.add(i)
+        changes = True
+  keep  = [i for i, line in enumerate(code) if i not in removed and line[1] != 'input']
+  # Belts from the kept part into the removed nodes
+  spare = ['k%d' % q for k in sorted(removed) for q in code[k][2:] if q not in removed]
+  flow  = sum(code[q][0] / len(consumers[q]) for k in removed for q in code[k][2:] if q not in removed)
+  goals = [code[0][0]] + [q for q in wanted for n in range(wanted[q])]
+  top = None
+  if keep and kept:
+    if spare:
+      top = multi_smartsplit([sum(nums), round(flow, 5)], goals, solve=solve)
+    else:
+      top = solve(*goals)
+  if top is None:
+    print("Nothing of the previous solution could be kept, solving from scratch")
+    return solve(*nums)
+  # The front's second input is the spare belt, and the output of the
+  # front with the old total takes the place of the old input.
+  spl = lines_to_labels(top, 't', ['s', 'x'] if spare else 's')
+  pos = find_output(spl, code[0][0], set())
+  sol = list_except(spl, pos)
+  if spare:
+    sol.append([round(flow, 5), 'x', 'merge'] + spare)
+  for i in keep:
+    srcs = [spl[pos][3] if q == 0 else 'k%d' % q for q in code[i][2:]]
+    sol.append([code[i][0], 'k%d' % i, code[i][1]] + srcs)
+  print("Keeping %d of %d nodes" % (len(keep), len(code)))
+  res = labels_to_lines(sol, 's', sum(nums))
+  validate(nums, res)
+  return cleanup(sum(nums), res)
+
+def exact_groups(rates, nums, limit=10000):
+  # Assign whole goals to sources so that every source is used up exactly.
+  order = sorted(range(len(nums)), key=lambda g: -nums[g])
+  left  = list(rates)
+  groups = [[] for r in rates]
+  tries = [0]
+  def assign(n):
+    tries[0] += 1
+    if n == len(order):
+      return all(abs(v) < 1e-9 for v in left)
+    g = order[n]
+    for k in range(len(rates)):
+      if left[k] >= nums[g] - 1e-9 and tries[0] < limit:
+        left[k] -= nums[g]
+        groups[k].append((g, nums[g]))
+        if assign(n+1):
+          return True
+        groups[k].pop()
+        left[k] += nums[g]
+    return False
+  return groups if assign(0) else None
+
+def cut_groups(rates, nums, order, sources):
+  # Walk the goals in "order" and the sources in "sources", filling each
+  # source up to its rate. A goal that straddles two sources is cut into
+  # pieces, which are merged back together afterwards.
+  groups = [[] for r in rates]
+  sources = list(sources)
+  k = sources.pop(0)
+  left = fractions.Fraction(rates[k])
+  for g in order:
+    need = fractions.Fraction(nums[g])
+    while need > 0:
+      take = need if not sources else min(need, left)
+      groups[k].append((g, float(take)))
+      need -= take
+      left -= take
+      if left <= 0 and sources:
+        k = sources.pop(0)
+        left = fractions.Fraction(rates[k])
+  return groups
+
+def multi_smartsplit(ratios, nums, solve=do_smartsplit):
+  # Feed the goals "nums" from several inputs whose rates are in the ratio
+  # "ratios". The goals are distributed among the inputs, and goals that
+  # are fed from more than one input are merged from pieces. Each input's
+  # share is an ordinary sub-problem, so equal shares are solved only once.
+  nums  = sorted(q for q in nums if q)
+  if len(ratios) == 1:
+    return solve(*nums)
+  # The rates are often fractions such as 18/7, which the search cannot
+  # solve. Scale everything so that they are whole numbers, and scale
+  # the result back at the end.
+  goals = [fractions.Fraction(q).limit_denominator() for q in nums]
+  rates = [fractions.Fraction(r).limit_denominator() for r in ratios]
+  rates = [r * sum(goals) / sum(rates) for r in rates]
+  scale = math.lcm(*(f.denominator for f in goals + rates))
+  nums  = [float(q * scale) for q in goals]
+  rates = [float(r * scale) for r in rates]
+  total = sum(nums)
+  candidates = []
+  groups = exact_groups(rates, nums)
+  if groups:
+    candidates.append(groups)
+  order = list(range(len(nums)))
+  for sources in set(itertools.permutations(range(len(rates)))):
+    candidates.append(cut_groups(rates, nums, order, sources))
+    candidates.append(cut_groups(rates, nums, order[::-1], sources))
+  first = ['s%d' % k for k in range(len(rates))]
   res = None
-  nums = [q for q in nums if q]
-  for option in smartsplit(sum(nums), nums):
-    if option is None:
+  for groups in candidates:
+    sol    = []
+    pieces = defaultdict(list)
+    for k, group in enumerate(groups):
+      code = solve(*sorted(piece for g,piece in group))
+      if code is None:
+        sol = None
+        break
+      spl  = lines_to_labels(code, 'a%d' % k, first[k])
+      used = set()
+      for g, piece in group:
+        pos = find_output(spl, piece, used)
+        used.add(pos)
+        pieces[g].append(spl[pos][3])
+      sol += list_except(spl, *used)
+    if sol is None:
       continue
+    for g, srcs in pieces.items():
+      sol += [[nums[g], 'm%d' % g, 'merge'] + srcs,
+              [nums[g], 'o%d' % g, 'output', 'm%d' % g]]
+    option = labels_to_lines(sol, first, rates)
     validate(nums, option)
-    option = cleanup(sum(nums), option)
+    option = cleanup(rates, option)
+    cost = eval_cost(option)
+    if res is None or cost < res[0]:
+      res = [cost, option]
+  # Merging all inputs into one and solving that is always possible
+  code = solve(*nums)
+  if code is not None:
+    sol = [[total, 'all', 'merge'] + first] + lines_to_labels(code, 'a', 'all')
+    option = cleanup(rates, labels_to_lines(sol, first, rates))
     cost = eval_cost(option)
     if res is None or cost < res[0]:
       res = [cost, option]
-  return res[1] if res else None
+  if res is None:
+    return None
+  return [[round(line[0] / scale, 5)] + line[1:] for line in res[1]]
 
-if len(sys.argv) == 1:
-  print("Usage: python3 smartsplit.py <output> [<...>]")
+def smooth_numbers(limit):
+  # The numbers 2^a * 3^b up to "limit", in increasing order.
+  res = []
+  p2 = 1
+  while p2 <= limit:
+    p3 = p2
+    while p3 <= limit:
+      res.append(p3)
+      p3 *= 3
+    p2 *= 2
+  return sorted(res)
+
+def approximate(nums, tolerance, limit=2**16):
+  # Find integers k_i whose sum D is of the form 2^a * 3^b, so that the
+  # outputs k_i * total / D are all within the relative error "tolerance"
+  # of the goals "nums". The smallest such D is used. Such a ratio is
+  # solved with a tree of splitters and no loop-backs.
+  # Returns the list of k_i in the order of "nums", and D.
+  total = sum(nums)
+  for D in smooth_numbers(limit):
+    # Each k_i has a range of its own, so some k_i add up to D
+    # exactly if D is between the sums of the ends of the ranges.
+    quotas = [q * D / total for q in nums]
+    lo = [max(1, math.ceil((1 - tolerance) * v)) for v in quotas]
+    hi = [math.floor((1 + tolerance) * v) for v in quotas]
+    if any(l > h for l,h in zip(lo, hi)) or not sum(lo) <= D <= sum(hi):
+      continue
+    # Hand out the rest one at a time, to the goal that is furthest below its quota
+    ks = lo
+    for n in range(D - sum(lo)):
+      i = max((i for i in range(len(ks)) if ks[i] < hi[i]), key=lambda i: quotas[i] - ks[i])
+      ks[i] += 1
+    if all(abs(k * total / D - q) <= tolerance * q for k,q in zip(ks, nums)):
+      return ks, D
+  return None
+
+def radix_split(ks, radices, total):
+  # Build a splitter tree for outputs k_i / D of "total", where D is the
+  # product of "radices". Level j splits every belt it gets into radices[j]
+  # pieces. Output i takes as many pieces from level j as the j-th
+  # mixed-radix digit of k_i says, and the remaining pieces go on to the
+  # next level. Because the k_i add up to D, nothing is left over.
+  D = math.prod(radices)
+  digits = []
+  for k in ks:
+    place, row = D, []
+    for r in radices:
+      place //= r
+      row.append(k // place)
+      k %= place
+    digits.append(row)
+  # Belts that continue past each level, from the bottom up
+  carry = [0] * len(radices)
+  for j in reversed(range(len(radices) - 1)):
+    carry[j] = (sum(row[j+1] for row in digits) + carry[j+1]) // radices[j+1]
+  sol   = []
+  belts = ['s']
+  value = total
+  srcs  = [[] for k in ks]
+  for j, r in enumerate(radices):
+    pieces = []
+    for n, b in enumerate(belts):
+      label = 'r%d_%d' % (j, n)
+      sol.append([value, label, 'split%d' % r, b])
+      pieces += [label] * r
+    value /= r
+    for i, row in enumerate(digits):
+      srcs[i] += pieces[:row[j]]
+      del pieces[:row[j]]
+    belts = pieces[:carry[j]]
+  if not radices:
+    # D == 1: a single output, which takes the whole input
+    srcs = [belts]
+  for i, k in enumerate(ks):
+    v = k * total / D
+    if len(srcs[i]) == 1:
+      sol.append([v, 'o%d' % i, 'output', srcs[i][0]])
+    else:
+      sol += [[v, 'm%d' % i, 'merge'] + srcs[i],
+              [v, 'o%d' % i, 'output', 'm%d' % i]]
+  return labels_to_lines(sol, 's', total)
+
+def smooth_smartsplit(ks, D, total):
+  # Outputs k_i / D of "total" where D = 2^a * 3^b. Such a ratio needs no
+  # loop-backs. The splitters can be in any order; try both extremes.
+  g  = math.gcd(D, *ks)
+  ks = [k // g for k in ks]
+  D //= g
+  radices = []
+  for r in (3, 2):
+    while D % r == 0:
+      radices.append(r)
+      D //= r
+  res = None
+  for order in (radices, radices[::-1]):
+    option = radix_split(ks, order, total)
+    if res is None or eval_cost(option) < eval_cost(res):
+      res = option
+  return res
+
+def looped_smartsplit(nums):
+  # Outputs "nums" in any ratio k_i / D of whole numbers, with no search.
+  # A splitter tree makes D' pieces, where D' is the smallest 2^a * 3^b
+  # that is at least D, and the D' - D spare pieces are merged back into
+  # the input. This always works, but often needs more buildings than
+  # what the search finds.
+  goals = [fractions.Fraction(q).limit_denominator() for q in nums]
+  scale = math.lcm(*(f.denominator for f in goals))
+  ks    = [int(q * scale) for q in goals]
+  g     = math.gcd(*ks)
+  ks    = [k // g for k in ks]
+  D     = sum(ks)
+  total = sum(nums)
+  Dp    = next(n for n in smooth_numbers(2 * D) if n >= D)
+  if Dp == D:
+    return smooth_smartsplit(ks, D, total)
+  loop  = total * Dp / D
+  spl   = lines_to_labels(smooth_smartsplit(ks + [Dp - D], Dp, loop), 'p', 'l')
+  # Any output of the spare value will do
+  pos   = find_output(spl, (Dp - D) * total / D, set())
+  sol   = list_except(spl, pos) + [[loop, 'l', 'merge', 's', spl[pos][3]]]
+  return labels_to_lines(sol, 's', total)
+
+parser = argparse.ArgumentParser(usage="python3 smartsplit.py [options] <output> [<...>]")
+parser.add_argument('outputs', nargs='*', type=float)
+parser.add_argument('--dag', action='store_true',
+                    help='solve bottom-up over a DAG of goal multisets instead of recursing')
+parser.add_argument('--hierarchical', action='store_true',
+                    help='solve groups of goals separately and join them with a splitter tree (for many outputs)')
+parser.add_argument('--previous', metavar='A:B:...', type=lambda s: [float(v) for v in s.split(':')],
+                    help='reuse as much as possible of the solution for these earlier outputs')
+parser.add_argument('--inputs', metavar='A:B:...', type=lambda s: [float(v) for v in s.split(':')],
+                    help='feed the outputs from several inputs with rates in this ratio')
+parser.add_argument('--exact', action='store_true',
+                    help='prove the solution minimal with an integer programming solver (needs pulp)')
+parser.add_argument('--time-limit', type=float, default=60,
+                    help='time limit in seconds for each step of --exact')
+parser.add_argument('--tolerance', type=float,
+                    help='accept outputs within this relative error (e.g. 0.01) if that gives a simpler ratio')
+parser.add_argument('--profile', metavar='FILE',
+                    help='write the time spent in each stage of the search to FILE, for flamegraph.pl')
+parser.add_argument('--dot', action='store_true',
+                    help='print the graph in DOT format instead of opening a viewer')
+parser.add_argument('--debug', action='store_true',
+                    help='simulate the flow through every candidate network')
+args = parser.parse_args()
+debug = args.debug
+if args.profile:
+  profiler = Profiler()
+
+if len(args.outputs) == 0:
+  print("Usage: python3 smartsplit.py [options] <output> [<...>]")
   sys.exit()
+if args.exact and args.inputs:
+  # exact.py models a single input only
+  parser.error('--exact cannot be combined with --inputs')
+if args.inputs and min(args.inputs) <= 0:
+  parser.error('--inputs rates must be positive')
+
+view_graph = not args.dot
 
-view_graph = True
+goals = args.outputs = [q for q in args.outputs if q]
+approx = None
+if args.tolerance:
+  for option in ('inputs', 'previous', 'hierarchical'):
+    if getattr(args, option):
+      parser.error('--tolerance cannot be combined with --' + option)
+  approx = approximate(goals, args.tolerance)
+  if approx is None:
+    print("No ratio within tolerance %g, solving exactly" % args.tolerance)
+
+solve = dag_smartsplit if args.dag else do_smartsplit
+if approx:
+  ks, D = approx
+  args.outputs = [k * sum(goals) / D for k in ks]
+  opt = smooth_smartsplit(ks, D, sum(goals))
+  validate(args.outputs, opt)
+  opt = cleanup(sum(goals), opt)
+  for q, v in zip(goals, args.outputs):
+    print("Output %g: got %g (%+.3f%%)" % (q, v, (v - q) / q * 100))
+elif args.inputs:
+  opt = multi_smartsplit(args.inputs, args.outputs, solve=solve)
+elif args.previous:
+  opt = incremental_smartsplit(args.previous, args.outputs, solve=solve)
+elif args.hierarchical:
+  opt = hierarchical_smartsplit(*args.outputs)
+else:
+  opt = solve(*args.outputs)
+if opt and args.exact:
+  opt, lower, best = exact_smartsplit(args.outputs, opt, args.time_limit)
+  if lower >= best:
+    print("Optimal: %d buildings" % best)
+  else:
+    print("Best found: %d buildings, lower bound %d" % (best, lower))
 
-opt = do_smartsplit(*(float(v) for v in sys.argv[1:]))
 if opt:
   for i,line in enumerate(opt):
     print("%3d: %s" % (i, line))
@@ -441,4 +899,10 @@ if opt:
 else:
   print("No solution")
 
+if args.profile:
+  profiler.write(args.profile)
+  print("Profile written to %s. Most time spent in:" % args.profile)
+  for line in profiler.summary():
+    print(line)
+
 cached.save()
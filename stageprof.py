@@ -0,0 +1,113 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+# Profiler for the search tree of smartsplit.py (--profile).
+# Time is charged to a stack of frames such as "twoway 1:2:4", which name
+# a stage of the search and the goals it is working on, instead of to
+# Python functions. The stages of one sub-problem run inside a generator
+# that is suspended whenever it yields a candidate, so a generator's frame
+# is only on the stack while the generator is running.
+# The result is written as collapsed stacks ("frame;frame;frame count"),
+# with the self time in microseconds, which flamegraph.pl and speedscope
+# can read.
+
+def frame_name(stage, goals):
+    return '%s %s' % (stage, ':'.join('%g' % q for q in goals))
+
+class NullProfiler:
+    """The default: does nothing."""
+    def frame(self, stage, goals):
+        return nullcontext()
+    def generator(self, stage, goals, gen):
+        return gen
+    def stage(self, stage):
+        pass
+
+class Profiler:
+    def __init__(self):
+        self.frames = []   # [stage, name] of every frame on the stack
+        self.path   = ()
+        self.self_time = defaultdict(float)
+        self.calls     = defaultdict(int)
+        self.last = time.perf_counter()
+
+    def charge(self):
+        now = time.perf_counter()
+        self.self_time[self.path] += now - self.last
+        self.last = now
+
+    def push(self, frame):
+        self.charge()
+        self.frames.append(frame)
+        self.path += (frame[1],)
+
+    def pop(self):
+        self.charge()
+        self.frames.pop()
+        self.path = self.path[:-1]
+
+    @contextmanager
+    def frame(self, stage, goals):
+        self.push([stage, frame_name(stage, goals)])
+        self.calls[self.path] += 1
+        try:
+            yield
+        finally:
+            self.pop()
+
+    def generator(self, stage, goals, gen):
+        # The frame is kept between the steps, so that stage() changes
+        # made by the generator persist while it is suspended.
+        frame = [stage, frame_name(stage, goals)]
+        self.calls[self.path + (frame[1],)] += 1
+        while True:
+            self.push(frame)
+            try:
+                item = next(gen)
+            except StopIteration:
+                return
+            finally:
+                self.pop()
+            yield item
+
+    def stage(self, stage):
+        """Move the innermost frame on to another stage, for the same goals."""
+        self.charge()
+        frame = self.frames[-1]
+        frame[1] = stage + frame[1][len(frame[0]):]
+        frame[0] = stage
+        self.path = self.path[:-1] + (frame[1],)
+        self.calls[self.path] += 1
+
+    def write(self, file):
+        with open(file, 'w') as out:
+            for path, t in sorted(self.self_time.items()):
+                if path and round(t * 1e6):
+                    out.write('%s %d\n' % (';'.join(path), round(t * 1e6)))
+
+    def summary(self, count=10):
+        """
+        The self time and call count of every stage, and of the frames
+        with the most self time, summed over all the stacks they are in.
+        """
+        total = defaultdict(float)
+        calls = defaultdict(int)
+        for path, t in self.self_time.items():
+            if path:
+                total[path[-1]] += t
+        for path, n in self.calls.items():
+            calls[path[-1]] += n
+        stages = defaultdict(float)
+        stage_calls = defaultdict(int)
+        for name in total.keys() | calls.keys():
+            stage = name.split(' ')[0]
+            stages[stage] += total[name]
+            stage_calls[stage] += calls[name]
+        res = []
+        for name in sorted(stages, key=stages.get, reverse=True):
+            res.append('%10.3f s %7d  %s' % (stages[name], stage_calls[name], name))
+        res.append('')
+        for name in sorted(total, key=total.get, reverse=True)[:count]:
+            res.append('%10.3f s %7d  %s' % (total[name], calls[name], name))
+        return res
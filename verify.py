@@ -0,0 +1,214 @@
+from fractions import Fraction
+from collections import defaultdict
+
+# Independent check that a network really delivers its flows.
+# Every node carries an unknown inflow x[i]. An input carries its own value,
+# and every other node receives, from each source it refers to, that
+# source's inflow divided by the number of references to the source.
+# Loop-back merges make this a linear system rather than a simple
+# propagation. The graph is cut into strongly connected components, which
+# are solved in topological order: a component without a loop is a plain
+# sum, and the loops are solved with Gauss-Jordan elimination.
+# The arithmetic is done with exact fractions by default; floats are
+# several times faster and good enough for checking search candidates.
+
+eps = 1e-4
+
+def components(code):
+    """Tarjan's algorithm. Yields the strongly connected components, sources first."""
+    index, low, stack, on_stack = {}, {}, [], set()
+    for root in range(len(code)):
+        if root in index:
+            continue
+        work = [(root, 2)]
+        while work:
+            v, pos = work.pop()
+            if pos == 2:
+                index[v] = low[v] = len(index)
+                stack.append(v)
+                on_stack.add(v)
+            elif pos > 2:
+                low[v] = min(low[v], low[code[v][pos-1]])
+            for p in range(pos, len(code[v])):
+                q = code[v][p]
+                if q not in index:
+                    work.append((v, p+1))
+                    work.append((q, 2))
+                    break
+                if q in on_stack:
+                    low[v] = min(low[v], index[q])
+            else:
+                if low[v] == index[v]:
+                    comp = []
+                    while True:
+                        q = stack.pop()
+                        on_stack.discard(q)
+                        comp.append(q)
+                        if q == v:
+                            break
+                    yield comp
+
+def solve_loop(comp, rows, rhs):
+    """Gauss-Jordan elimination of the equations of one component."""
+    for n, i in enumerate(comp):
+        p = max(comp[n:], key=lambda j: abs(rows[j].get(i, 0)))
+        if not rows[p].get(i):
+            return False
+        if p != i:
+            rows[i], rows[p] = rows[p], rows[i]
+            rhs[i],  rhs[p]  = rhs[p],  rhs[i]
+        piv = rows[i][i]
+        if piv != 1:
+            for k in rows[i]:
+                rows[i][k] /= piv
+            rhs[i] /= piv
+        for j in comp:
+            f = rows[j].get(i) if j != i else None
+            if f:
+                for k, v in rows[i].items():
+                    rows[j][k] -= f * v
+                    if rows[j][k] == 0:
+                        del rows[j][k]
+                rhs[j] -= f * rhs[i]
+    return True
+
+def simulate(code, num=Fraction):
+    """
+    Return the steady-state inflow of every node as a list of "num",
+    or None if the flows are not determined (e.g. a closed loop).
+    """
+    refs = defaultdict(int)
+    for line in code:
+        for q in line[2:]:
+            refs[q] += 1
+    flow = [None] * len(code)
+    for comp in components(code):
+        members = set(comp)
+        if len(comp) == 1 and comp[0] not in code[comp[0]][2:]:
+            i = comp[0]
+            if code[i][1] == 'input':
+                flow[i] = num(code[i][0])
+            else:
+                flow[i] = sum((flow[q] / refs[q] for q in code[i][2:]), num(0))
+            continue
+        # Equations x[i] - (flow from inside the loop) = flow from outside
+        rows, rhs = {}, {}
+        for i in comp:
+            rows[i] = defaultdict(num)
+            rows[i][i] += 1
+            rhs[i] = num(0)
+            if code[i][1] == 'input':
+                rhs[i] = num(code[i][0])
+                continue
+            for q in code[i][2:]:
+                if q in members:
+                    rows[i][q] -= num(1) / refs[q]
+                else:
+                    rhs[i] += flow[q] / refs[q]
+        if not solve_loop(comp, rows, rhs):
+            return None
+        for i in comp:
+            flow[i] = rhs[i]
+    return flow
+
+def close(a, b):
+    return abs(a - b) <= eps * max(1, abs(b))
+
+def verify(goals, code, num=Fraction):
+    """
+    Simulate the flow through "code" and return a list of problems found,
+    which is empty if the network delivers exactly "goals".
+    """
+    problems = []
+    refs = defaultdict(int)
+    for i, line in enumerate(code):
+        for q in line[2:]:
+            if not (0 <= q < len(code)) or q == i:
+                problems.append("node %d: bad source %s" % (i, q))
+                return problems
+            refs[q] += 1
+    for i, line in enumerate(code):
+        kind = line[1]
+        if kind[:5] == 'split':
+            if kind != 'split' and refs[i] != int(kind[5:]):
+                problems.append("node %d: %s has %d outputs" % (i, kind, refs[i]))
+        elif kind == 'output':
+            if refs[i] != 0:
+                problems.append("node %d: output feeds %d nodes" % (i, refs[i]))
+        elif kind in ('input', 'merge'):
+            if refs[i] != 1:
+                problems.append("node %d: %s feeds %d nodes" % (i, kind, refs[i]))
+        else:
+            problems.append("node %d: unknown kind %s" % (i, kind))
+    flow = simulate(code, num)
+    if flow is None:
+        problems.append("flows are not determined")
+        return problems
+    for i, line in enumerate(code):
+        if not close(float(flow[i]), line[0]):
+            problems.append("node %d: %s %g carries %g" % (i, line[1], line[0], flow[i]))
+    found = sorted(float(flow[i]) for i, line in enumerate(code) if line[1] == 'output')
+    goals = sorted(goals)
+    if len(found) != len(goals) or not all(close(a, b) for a, b in zip(found, goals)):
+        problems.append("outputs %s do not match goals %s" % (found, goals))
+    return problems
+
+# Timed check of --hierarchical: outputs in simple steps, and rates as
+# they come up in a real factory. Each run must finish in the given time.
+hierarchical_checks = [
+    list(range(1, 21)),
+    list(range(1, 41)),
+    [15, 15, 15, 30, 22.5, 45, 60, 7.5, 10, 20, 12, 5, 5, 5, 12,
+     40, 37.5, 25, 8, 18, 6, 30, 50, 9, 14, 27, 33, 48, 11, 52],
+]
+hierarchical_time = 60
+
+def check_hierarchical():
+    import ast, os, subprocess, sys, time
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'smartsplit.py')
+    bad = 0
+    for goals in hierarchical_checks:
+        start = time.time()
+        try:
+            out = subprocess.run([sys.executable, script, '--hierarchical', '--dot'] +
+                                 ['%g' % q for q in goals], capture_output=True,
+                                 text=True, timeout=hierarchical_time).stdout
+            problems = []
+        except subprocess.TimeoutExpired:
+            out = ''
+            problems = ['no result in %d s' % hierarchical_time]
+        # The network is printed as "  3: [value, kind, sources...]"
+        code = [ast.literal_eval(line.split(':', 1)[1].strip())
+                for line in out.splitlines() if line[:3].strip().isdigit() and line[3:4] == ':']
+        if not problems:
+            problems = verify(goals, code) if code else ['no solution']
+        print("%d outputs: %d nodes in %.1f s" % (len(goals), len(code), time.time() - start))
+        for p in problems:
+            print("  " + p)
+        bad += bool(problems)
+    print("%d runs checked, %d failed" % (len(hierarchical_checks), bad))
+
+if __name__ == '__main__':
+    import sys
+    if sys.argv[1:] == ['--hierarchical']:
+        check_hierarchical()
+        sys.exit()
+    # Check the whole cache
+    from cache import load
+    from network import expand
+    cache = load()
+    memo = {}
+    good = bad = 0
+    for key in cache:
+        code = expand(cache, key, memo)
+        if code is None:
+            continue
+        problems = verify([q for q in key if q], code)
+        if problems:
+            bad += 1
+            print(key)
+            for p in problems:
+                print("  " + p)
+        else:
+            good += 1
+    print("%d cached solutions verified, %d failed" % (good, bad))